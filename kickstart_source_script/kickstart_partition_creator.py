@@ -6,7 +6,7 @@ __intname__ = "kickstart.partition_script.RHEL9"
 __author__ = "Orsiris de Jong"
 __copyright__ = "Copyright (C) 2022-2024 Orsiris de Jong - NetInvent SASU"
 __licence__ = "BSD 3-Clause"
-__build__ = "2024111701"
+__build__ = "2026101901"
 
 ### This is a pre-script for kickstart files in RHEL 9
 ### Allows specific partition schemes with one or more data partitions
@@ -47,6 +47,22 @@ IS_USER_PASSWORD_CRYPTED = True
 # The following password is the output of openssl passwd -6 MySecretPWD123!
 USER_PASSWORD = r"$6$ptVdrpI1pqmpTy/Y$8/D4oJbofV4ZsyZ1hSXn.biyw6fDA9qozGXK3B0lXB5c39XJ.tlzv5v5Hedx7cI1uLPrVlB.Ua6n4mk/iYgcN0"
 
+## Disk encryption
+# Add "encrypted": True to any partition of the partition schemas below in order to encrypt it with LUKS2
+# Passphrase for encrypted partitions, if None, anaconda will ask for it interactively
+LUKS_PASSPHRASE = None
+# Ciphers we consider compliant, ANSSI only recommends AES-XTS for disk encryption
+# If more ciphers are added, the fastest one on the target machine will be selected via cryptsetup benchmark
+# Key size is always 512 bits (2x256 bits AES keys in XTS mode), which is what anaconda uses with XTS ciphers
+LUKS_COMPLIANT_CIPHERS = ["aes-xts-plain64"]
+LUKS_KEY_SIZE = 512
+
+## Disk selection
+# Unless DISK_PATH is given as kernel argument, the install disk is selected by ranking non hotplug disks
+# by transport (nvme > sas > sata), non rotational disks first, then in lsblk order
+# Enable DISK_PROBE to break ties between disks of the same kind with a short non destructive read probe
+DISK_PROBE = False
+
 ## Hostname
 HOSTNAME = "machine.npf.local"
 
@@ -57,10 +73,24 @@ HOSTNAME = "machine.npf.local"
 NETWORK = "dhcp"
 
 # Please note that the following arguments can be superseeded by kernel arguments
-# TARGET, USER_NAME, USER_PASSWORD, ROOT_PASSWORD, HOSTNAME, DISK_PATH (the disk we're installing the OS to, eg something like /dev/sda or /dev/vda or /dev/nvme0)
+# TARGET, USER_NAME, USER_PASSWORD, ROOT_PASSWORD, HOSTNAME, LUKS_PASSPHRASE, INSTALL_IMAGE_URL, INSTALL_IMAGE_CHECKSUM, FORCE_POSTINSTALL, DISK_PATH (the disk we're installing the OS to, eg something like /dev/sda or /dev/vda or /dev/nvme0)
 # You need to specify that kernel argument as NPF_{ARGUMENT_NAME}=value, example
 # append initrd=initrd.img inst.ks=hd:LABEL=MYDISK:/ks.rhel9.cfg NPF_USER_NAME=bob
 
+## Image based provisioning
+# Instead of installing packages, anaconda can restore a prebuilt golden image into the computed partition plan
+# Only per host settings (hostname, network, users) will be applied on top of the image
+# The image can be a tarball (tar, tgz, txz, tbz) or a squashfs / filesystem image, see kickstart liveimg documentation
+# A tarball can be created on the golden machine with
+# tar --xattrs --acls --selinux --one-file-system -cpJf /golden.tar.xz --exclude=/golden.tar.xz / /boot /var ...
+# Example: INSTALL_IMAGE_URL = "file:///run/install/repo/golden.tar.xz" or "https://images.local/golden.tar.xz"
+# Set to None to make a standard package installation from CDROM
+INSTALL_IMAGE_URL = None
+# Optional sha256 checksum of the image
+INSTALL_IMAGE_CHECKSUM = None
+# The post install script is skipped when the image already went through it, set to True to run it anyway
+FORCE_POSTINSTALL = False
+
 ## Package management
 # Add lm-sensros and smartmontools on physical machines
 ADD_PHYSICAL_PACKAGES = True
@@ -74,6 +104,8 @@ REMOVE_VIRTUAL_PACKAGES = True
 # - <nn%>: Percentage of remaining size after fixed size has been allocated
 # - True: Fill up remaining space after fixed and percentage size has been allocated
 #         If multiple True values exist, we'll divide by percentages of remaining space
+# - "stateful": Size computed from the readonly-root stateful storage budget, see READONLY_* settings below
+# Partitions can be encrypted by adding "encrypted": True (not supported for partitions without mountpoint)
 
 # Partition schema for standard KVM Hypervisor
 PARTS_HV = [
@@ -85,13 +117,13 @@ PARTS_HV = [
 PARTS_HV_STATELESS = [
     {"size": 30720, "fs": "xfs", "mountpoint": "/"},
     {"size": True, "fs": "xfs", "mountpoint": "/var/lib/libvirt/images", "fsoptions": "nodev,nosuid,noexec"},
-    {"size": 30720, "fs": "xfs", "mountpoint": None, "label": "STATEFULRW"},
+    {"size": "stateful", "fs": "xfs", "mountpoint": None, "label": "STATEFULRW"},
 ]
 
 # Partition schema for stateless machines
 PARTS_STATELSSS = [
     {"size": True, "fs": "xfs", "mountpoint": "/"},
-    {"size": True, "fs": "xfs", "mountpoint": None, "label": "STATEFULRW"},
+    {"size": "stateful", "fs": "xfs", "mountpoint": None, "label": "STATEFULRW"},
 ]
 
 # Partition schema for generic machines with only one big root partition
@@ -124,6 +156,65 @@ PARTS_ANSSI = [
     {"size": 2048, "fs": "xfs", "mountpoint": "/var/log/audit", "fsoptions": "nodev,nosuid,noexec"},
 ]
 
+## Readonly-root storage budget (stateless and hv-stateless targets)
+# The directory lists below mirror the statetab and rwtab entries that optional_tasks/setup_readonly.sh writes,
+# keep them in sync. stateless target is set up as setup_readonly.sh ztl target, hv-stateless as hv target
+# Estimated size in MiB of persistent directories that readonly-root keeps on the STATEFULRW partition (statetab)
+READONLY_PERSISTENT_DIRS = {
+    "/var/log": 4096,
+    "/var/cache": 2048,
+    "/var/lib/dnf": 512,
+    "/var/lib/pcp": 2048,
+    "/var/lib/prometheus": 10240,
+    "/var/lib/node_exporter": 64,
+    "/var/lib/rsyslog": 64,
+    "/etc/snmp": 16,
+    "/etc/NetworkManager/system-connections": 16,
+    "/etc/prometheus": 64,
+    "/etc/pcp": 16,
+}
+# Additional persistent directories for hv-stateless target
+READONLY_HV_PERSISTENT_DIRS = {
+    "/var/lib/libvirt": 2048,
+    "/etc/libvirt": 64,
+}
+# Additional persistent directories for stateless (ztl) target
+READONLY_ZTL_PERSISTENT_DIRS = {
+    "/var/ztl": 2048,
+    "/etc/firewalld/zones": 16,
+    "/etc/systemd/system": 16,
+}
+# Estimated size in MiB of volatile directories that readonly-root keeps in tmpfs until reboot (rwtab)
+# This includes the stock /etc/rwtab entries shipped with readonly-root, where /tmp and /var/tmp
+# are the ones that actually grow, so they get a 1GiB floor each
+READONLY_VOLATILE_DIRS = {
+    "/tmp": 1024,
+    "/var/tmp": 1024,
+    "/var/spool": 64,
+    "/var/cache/man": 64,
+    "/var/lib/NetworkManager": 8,
+    "/var/lib/dhclient": 8,
+    "/var/lib/nfs": 8,
+    "/var/lib/dbus": 8,
+    "/var/lib/systemd/timers": 1,
+    "/etc/lvm": 16,
+    "/var/log/tuned": 64,
+    "/etc/issue": 1,
+}
+# Additional volatile directories for stateless (ztl) target
+READONLY_ZTL_VOLATILE_DIRS = {
+    "/var/ztl_upgrade": 1024,
+    "/etc/wireguard": 1,
+    "/var/lib/haproxy": 16,
+}
+# Percentage added to estimated sizes as safety margin
+READONLY_BUDGET_MARGIN = 50
+# Maximum tmpfs size as percentage of RAM, so oversized tmpfs cannot OOM the machine
+# This is only an upper cap, on small machines it wins over the volatile directories estimates
+READONLY_TMPFS_MAX_RAM_PERCENT = 25
+# Maximum stateful partition size as percentage of usable disk space
+READONLY_STATEFUL_MAX_DISK_PERCENT = 50
+
 #################################################################
 # DO NOT MODIFY BELOW THIS LINE UNLESS YOU KNOW WHAT YOU'RE DOING
 #################################################################
@@ -131,10 +222,14 @@ PARTS_ANSSI = [
 
 import sys
 import os
+import shlex
+import mmap
+import random
 from typing import Tuple, Optional
 import subprocess
 import logging
-from time import sleep
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 def dirty_cmd_runner(cmd: str) -> Tuple[int, str]:
@@ -168,7 +263,8 @@ def get_kernel_arguments() -> dict:
         return None
     
     argument_list = [
-        "TARGET", "USER_NAME", "USER_PASSWORD", "ROOT_PASSWORD", "HOSTNAME", "NETWORK", "DISK_PATH"
+        "TARGET", "USER_NAME", "USER_PASSWORD", "ROOT_PASSWORD", "HOSTNAME", "NETWORK", "LUKS_PASSPHRASE",
+        "INSTALL_IMAGE_URL", "INSTALL_IMAGE_CHECKSUM", "FORCE_POSTINSTALL", "DISK_PATH"
     ]
 
     kernel_arguments = {}
@@ -192,6 +288,19 @@ def is_gpt_system() -> bool:
     return is_gpt
 
 
+def is_virtual_system() -> bool:
+    is_virtual, _ = dirty_cmd_runner("lsmod | grep virtio > /dev/null 2>&1")
+    if not is_virtual:
+        is_virtual, _ = dirty_cmd_runner(
+            r'dmidecode | grep -i "kvm\|qemu\|vmware\|hyper-v\|virtualbox\|innotek\|Manufacturer: Red Hat\|NetPerfect\|netperfect_vm"'
+        )
+    if is_virtual:
+        logger.info("We're running on a virtual machine")
+    else:
+        logger.info("We're running on a physical machine")
+    return is_virtual
+
+
 def get_mem_size() -> int:
     """
     Returns memory size in MiB
@@ -207,28 +316,225 @@ def get_mem_size() -> int:
     return mem_mib
 
 
-def get_first_disk_path() -> list:
+def get_disk_candidates() -> list:
     """
-    Return list of disks
+    Return list of non hotplug disks with their properties
 
-    First, let's get the all the available disk names (ex hda,sda,vda)
     We might have a /dev/zram0 device which is considered as disk, so we need to filter vdX,sdX,hdX
     """
-    if DEV_MOCK:
-        return "/dev/vdx"
     # -I only include disk types 8 = hard disk, 252 = vdisk, 259 = nvme disk
-    # -ndp -n no headers, -d only devices (no partitions), -p show full path
-    # --output NAME,TYPE,HOTPLUG only output name and type
-    # awk will filter by non hotplug devices and return a line per disk
-    cmd = r"lsblk -I 8,252,259 -ndp --output HOTPLUG,NAME | awk '{ if ($1 == 0) { print $2 }}'"
+    # -ndpb -n no headers, -d only devices (no partitions), -p show full path, -b size in bytes
+    # -P output key="value" pairs so empty transports (virtio) don't shift columns
+    cmd = r"lsblk -I 8,252,259 -ndpb -P --output HOTPLUG,NAME,TRAN,ROTA,SIZE"
     result, output = dirty_cmd_runner(cmd)
-    if result:
-        disk_path = output.split("\n")[0].strip()
-        logger.info(f"First usable disk is {disk_path}")
-        return disk_path
+    if not result:
+        logger.error(f"Cannot list disks: {output}")
+        return []
+    disks = []
+    for line in output.split("\n"):
+        if not line.strip():
+            continue
+        properties = dict(pair.split("=", 1) for pair in shlex.split(line))
+        if properties.get("HOTPLUG") != "0":
+            continue
+        try:
+            size = int(properties.get("SIZE", 0))
+        except ValueError:
+            size = 0
+        # Skip empty devices, eg card readers without card
+        if not size:
+            continue
+        disks.append(
+            {
+                "path": properties["NAME"],
+                "transport": properties.get("TRAN", ""),
+                "rotational": properties.get("ROTA") == "1",
+                "size": size,
+            }
+        )
+    return disks
+
+
+def probe_disk(disk_path: str) -> Tuple[float, float]:
+    """
+    Non destructive disk probe using direct IO reads, returns average 4KiB random read latency in ms
+    and sequential read throughput in MiB/s
+    """
+    block_size = 4096
+    chunk_size = 1048576
+    latency_reads = 32
+    throughput_size = 64 * chunk_size
+    # mmap buffers are page aligned, which O_DIRECT requires
+    block_buffer = mmap.mmap(-1, block_size)
+    chunk_buffer = mmap.mmap(-1, chunk_size)
+    fd = os.open(disk_path, os.O_RDONLY | os.O_DIRECT)
+    try:
+        disk_size = os.lseek(fd, 0, os.SEEK_END)
+        start_time = monotonic()
+        for _ in range(latency_reads):
+            offset = random.randrange(0, disk_size // block_size) * block_size
+            os.preadv(fd, [block_buffer], offset)
+        latency = (monotonic() - start_time) * 1000 / latency_reads
+
+        read_size = 0
+        start_time = monotonic()
+        while read_size < min(throughput_size, disk_size - chunk_size):
+            read_size += os.preadv(fd, [chunk_buffer], read_size)
+        throughput = read_size / chunk_size / (monotonic() - start_time)
+    finally:
+        os.close(fd)
+        block_buffer.close()
+        chunk_buffer.close()
+    return latency, throughput
+
+
+def get_install_disk_path() -> Optional[str]:
+    """
+    Select the disk to install to
+
+    Disks are ranked by transport (nvme > sas > sata > others), non rotational disks first
+    Disks with the same transport and rotational flag keep lsblk order, which is what we used before ranking
+    If DISK_PROBE is enabled, those disks are ranked by a short read probe instead
+    """
+    if DEV_MOCK:
+        return "/dev/vdx"
+
+    transport_ranks = {"nvme": 3, "sas": 2, "sata": 1}
+
+    def disk_class(disk: dict) -> Tuple[bool, int]:
+        return not disk["rotational"], transport_ranks.get(disk["transport"], 0)
+
+    disks = get_disk_candidates()
+    if not disks:
+        logger.error("Cannot find usable disk")
+        return None
+
+    if DISK_PROBE:
+        best_class = max(disk_class(disk) for disk in disks)
+        for disk in disks:
+            if disk_class(disk) != best_class:
+                continue
+            try:
+                latency, throughput = probe_disk(disk["path"])
+                # Score is throughput penalized by latency so both matter
+                disk["probe_score"] = throughput / (1 + latency)
+                logger.info(f"Disk {disk['path']} probe: {latency:.2f}ms latency, {throughput:.0f}MiB/s throughput")
+            except OSError as exc:
+                logger.info(f"Cannot probe disk {disk['path']}: {exc}")
+
+    first_disk_path = disks[0]["path"]
+    # Sort is stable, even when reversed, so disks of the same class keep lsblk order
+    disks.sort(key=lambda disk: (disk_class(disk), disk.get("probe_score", 0)), reverse=True)
+    logger.info("Disk ranking:")
+    for rank, disk in enumerate(disks, start=1):
+        logger.info(
+            f"  {rank}: {disk['path']} transport={disk['transport'] if disk['transport'] else 'unknown'} "
+            f"rotational={disk['rotational']} size={int(disk['size'] / 1048576)}MiB"
+        )
+    disk_path = disks[0]["path"]
+    if disk_path != first_disk_path:
+        logger.warning(
+            f"Selected install disk {disk_path} is not the first disk {first_disk_path}. "
+            "Use NPF_DISK_PATH kernel argument to force the install disk"
+        )
+    logger.info(f"Selected install disk is {disk_path}")
+    return disk_path
+
+
+def validate_encryption_schema(selected_partition_schema: list) -> bool:
+    """
+    Check that encrypted partitions of the selected schema can be handled by kickstart
+    """
+    for partition in selected_partition_schema:
+        if partition.get("encrypted", False) and partition["mountpoint"] is None:
+            logger.error(
+                "Encryption of partitions without mountpoint is not supported, since kickstart won't handle them"
+            )
+            return False
+    return True
+
 
-    logger.error(f"Cannot find usable disk: {output}")
-    return False
+def is_encryption_requested(selected_partition_schema: list) -> bool:
+    """
+    Check whether at least one partition of the selected schema needs encryption
+    """
+    return any(partition.get("encrypted", False) for partition in selected_partition_schema)
+
+
+def get_luks_options(disk_path: str) -> dict:
+    """
+    Select LUKS options for the target machine
+
+    Cipher is selected by running cryptsetup benchmark on every compliant cipher, since choosing
+    a cipher without CPU acceleration can halve disk throughput
+    dm-crypt workqueues are disabled on non rotational NVMe disks, since those are fast enough
+    so queuing adds latency instead of removing it
+    """
+    luks_options = {
+        "cipher": LUKS_COMPLIANT_CIPHERS[0],
+        "no_workqueue": False,
+    }
+    if DEV_MOCK:
+        return luks_options
+
+    best_speed = 0
+    for cipher in LUKS_COMPLIANT_CIPHERS:
+        cmd = f"cryptsetup benchmark --cipher {cipher} --key-size {LUKS_KEY_SIZE}"
+        result, output = dirty_cmd_runner(cmd)
+        if not result:
+            logger.info(f"Cannot benchmark cipher {cipher}: {output}")
+            continue
+        # Output line looks like "aes-xts        512b      2926.0 MiB/s      2935.3 MiB/s"
+        algorithm = cipher.rsplit("-", 1)[0]
+        for line in output.split("\n"):
+            columns = line.split()
+            if len(columns) < 6 or columns[0] != algorithm:
+                continue
+            try:
+                speed = float(columns[2]) + float(columns[4])
+            except ValueError:
+                continue
+            logger.info(f"Cipher {cipher} with {LUKS_KEY_SIZE} bits key: {columns[2]} MiB/s encryption, {columns[4]} MiB/s decryption")
+            if speed > best_speed:
+                best_speed = speed
+                luks_options["cipher"] = cipher
+    if not best_speed:
+        logger.info(f"Could not benchmark ciphers, falling back to {luks_options['cipher']}")
+
+    disk_name = os.path.basename(disk_path)
+    try:
+        with open(f"/sys/block/{disk_name}/queue/rotational", "r", encoding="utf-8") as fp:
+            is_rotational = fp.read().strip() == "1"
+        if disk_name.startswith("nvme") and not is_rotational:
+            luks_options["no_workqueue"] = True
+    except OSError as exc:
+        logger.info(f"Cannot read {disk_name} queue properties: {exc}")
+
+    logger.info(f"Selected LUKS options: {luks_options}")
+    return luks_options
+
+
+def get_luks_kickstart_options(part_properties: dict) -> str:
+    """
+    Return kickstart part / logvol encryption options for a partition
+    Anaconda lets cryptsetup choose the sector size, which will match the disk physical sector size
+    No workqueue flags are not supported by kickstart and are set via /etc/crypttab in post script
+    """
+    if not part_properties.get("encrypted", False) or not LUKS_OPTIONS:
+        return ""
+    luks = f' --encrypted --luks-version=luks2 --cipher={LUKS_OPTIONS["cipher"]} --pbkdf=argon2id'
+    if LUKS_PASSPHRASE:
+        luks += f" --passphrase={shlex.quote(LUKS_PASSPHRASE)}"
+    return luks
+
+
+def get_partition_path(disk_path: str, part_number) -> str:
+    """
+    Return the device path of a disk partition
+    Disks which name ends with a digit (nvme0n1, mmcblk0) use a "p" separator, eg /dev/nvme0n1p1
+    """
+    separator = "p" if disk_path[-1].isdigit() else ""
+    return f"{disk_path}{separator}{part_number}"
 
 
 def zero_disk(disk_path: str) -> bool:
@@ -238,7 +544,7 @@ def zero_disk(disk_path: str) -> bool:
     in order to have a custom partition schema
     We'll also wipe partitions and then the partition table
     """
-    cmd = f"dd if=/dev/zero of={disk_path} bs=512 count=1 conv=notrunc; wipefs -a {disk_path}[0-9] -f; wipefs -a {disk_path} -f"
+    cmd = f"dd if=/dev/zero of={disk_path} bs=512 count=1 conv=notrunc; wipefs -a {get_partition_path(disk_path, '[0-9]*')} -f; wipefs -a {disk_path} -f"
     logger.info(f"Zeroing disk {disk_path}")
     if DEV_MOCK:
         return True
@@ -297,6 +603,59 @@ def get_disk_size_mb(disk_path: str) -> int:
         return False
 
 
+def get_usable_disk_space(disk_space_mb: int) -> int:
+    """
+    Return usable disk space in MiB, optionally reserving some space on physical disks
+    """
+    usable_disk_space = disk_space_mb - 2  # keep 1KiB empty at beginning and 1MiB at end
+    if not IS_VIRTUAL and REDUCE_PHYSICAL_DISK_SPACE:
+        # Let's reserve 5% of disk space on physical machine
+        real_usable_disk_space = usable_disk_space
+        usable_disk_space = int(
+            usable_disk_space * (100 - REDUCE_PHYSICAL_DISK_SPACE) / 100
+        )
+        logger.info(
+            f"Reducing usable disk space by {REDUCE_PHYSICAL_DISK_SPACE}% from {real_usable_disk_space} to {usable_disk_space} since we deal with physical disks"
+        )
+    return usable_disk_space
+
+
+def get_readonly_budget() -> dict:
+    """
+    Compute readonly-root stateful partition size and volatile tmpfs size in MiB together
+    Stateful size comes from persistent directories estimates, capped by disk size
+    tmpfs size comes from volatile directories estimates, capped by RAM size
+    Also returns each persistent directory share of the stateful partition, so services sharing it can size themselves
+    """
+    persistent_dirs = dict(READONLY_PERSISTENT_DIRS)
+    volatile_dirs = dict(READONLY_VOLATILE_DIRS)
+    if TARGET == "hv-stateless":
+        persistent_dirs.update(READONLY_HV_PERSISTENT_DIRS)
+    else:
+        persistent_dirs.update(READONLY_ZTL_PERSISTENT_DIRS)
+        volatile_dirs.update(READONLY_ZTL_VOLATILE_DIRS)
+    estimated_persistent_size = sum(persistent_dirs.values())
+    persistent_size = int(estimated_persistent_size * (100 + READONLY_BUDGET_MARGIN) / 100)
+    volatile_size = int(sum(volatile_dirs.values()) * (100 + READONLY_BUDGET_MARGIN) / 100)
+
+    max_stateful_size = int(USABLE_DISK_SPACE * READONLY_STATEFUL_MAX_DISK_PERCENT / 100)
+    if persistent_size > max_stateful_size:
+        logger.info(f"Stateful budget of {persistent_size} MiB exceeds {READONLY_STATEFUL_MAX_DISK_PERCENT}% of disk space, reducing it to {max_stateful_size} MiB")
+        persistent_size = max_stateful_size
+
+    max_tmpfs_size = int(get_mem_size() * READONLY_TMPFS_MAX_RAM_PERCENT / 100)
+    if volatile_size > max_tmpfs_size:
+        logger.info(f"Volatile budget of {volatile_size} MiB exceeds {READONLY_TMPFS_MAX_RAM_PERCENT}% of RAM, reducing it to {max_tmpfs_size} MiB")
+        volatile_size = max_tmpfs_size
+
+    # Directory shares only shrink when the stateful partition had to be reduced below the estimates
+    share_ratio = min(1, persistent_size / estimated_persistent_size)
+    persistent_shares = {path: int(size * share_ratio) for path, size in persistent_dirs.items()}
+
+    logger.info(f"Readonly-root budget: {persistent_size} MiB stateful partition, {volatile_size} MiB tmpfs")
+    return {"stateful_size": persistent_size, "tmpfs_size": volatile_size, "persistent_shares": persistent_shares}
+
+
 def get_allocated_space(partitions_schema: dict) -> int:
     # Let's fill ROOT part with anything we can
     allocated_space = 0
@@ -312,6 +671,7 @@ def get_allocated_space(partitions_schema: dict) -> int:
 def get_partition_schema(selected_partition_schema: dict) -> dict:
     """
     Return a valid partition schema dict to apply with sizes and mountpoints, generated from the selected partition schema dict
+    Returns False when the selected partition schema cannot be applied
     """
 
     mem_size = get_mem_size()
@@ -351,13 +711,24 @@ def get_partition_schema(selected_partition_schema: dict) -> dict:
         for index, partition in enumerate(selected_partition_schema):
             # Shift index so we don't overwrite boot partition indexes
             index = str(int(index) + 10)
-            if not isinstance(partition["size"], bool) and isinstance(
+            if partition["size"] == "stateful":
+                if not READONLY_BUDGET:
+                    logger.error(
+                        f"Partition {partition.get('label', partition['mountpoint'])} uses stateful size, "
+                        f"but there is no readonly-root budget for target {TARGET}"
+                    )
+                    return False
+                size = READONLY_BUDGET["stateful_size"]
+            elif not isinstance(partition["size"], bool) and isinstance(
                 partition["size"], int
             ):
-                if LVM_ENABLED:
-                    partitions_schema["lvm"][index] = {"size": partition["size"]}
-                else:
-                    partitions_schema[index] = {"size": partition["size"]}
+                size = partition["size"]
+            else:
+                continue
+            if LVM_ENABLED:
+                partitions_schema["lvm"][index] = {"size": size}
+            else:
+                partitions_schema[index] = {"size": size}
         return partitions_schema
 
     def add_percent_size_partitions(partitions_schema):
@@ -416,14 +787,18 @@ def get_partition_schema(selected_partition_schema: dict) -> dict:
         logger.error(
             "We cannot create more than 4 parts in MBR mode (boot + swap + two other partitions)...Didn't bother to code that path for prehistoric systems. Consider enabling LVM"
         )
-        sys.exit(1)
+        return False
 
     # Create a basic partition schema
     partitions_schema = create_partition_schema()
     # Add fixed size partitions to partition schema
     partitions_schema = add_fixed_size_partitions(partitions_schema)
+    if not partitions_schema:
+        return False
     # Add percentage size partitions to partition schema
     partitions_schema = add_percent_size_partitions(partitions_schema)
+    if not partitions_schema:
+        return False
 
     filler_parts = get_number_of_filler_parts()
     logger.info(f"Number of filler partitions: {filler_parts}")
@@ -437,6 +812,8 @@ def get_partition_schema(selected_partition_schema: dict) -> dict:
                 selected_partition_schema[index]["size"] = str(int(100 / filler_parts)) + "%"
         # Now we have to do the percentage calculations again
         partitions_schema = add_percent_size_partitions(partitions_schema)
+        if not partitions_schema:
+            return False
     else:
         # Else just fill remaining partition with all space
         free_space = USABLE_DISK_SPACE - get_allocated_space(partitions_schema)
@@ -447,7 +824,7 @@ def get_partition_schema(selected_partition_schema: dict) -> dict:
             logger.error(
                 f"Usable disk space: {USABLE_DISK_SPACE}, schema allocated space: {get_allocated_space(partitions_schema)}"
             )
-            sys.exit(1)
+            return False
         for index, partition in enumerate(selected_partition_schema):
             index = str(int(index + 10))
             if isinstance(partition["size"], bool):
@@ -499,11 +876,12 @@ def prepare_non_kickstart_partitions(partitions_schema: dict) -> bool:
     """
 
     def prepare_non_kickstart_partition(part_properties, part_number):
+        partition_path = get_partition_path(DISK_PATH, part_number)
         if part_properties["mountpoint"] is None:
             logger.info(
-                f"Partition {DISK_PATH}{part_number} has no mountpoint and won't be handled by kickstart. Going to create it FS {part_properties['fs']}"
+                f"Partition {partition_path} has no mountpoint and won't be handled by kickstart. Going to create it FS {part_properties['fs']}"
             )
-            cmd = f'mkfs.{part_properties["fs"]} -f {DISK_PATH}{part_number}'
+            cmd = f'mkfs.{part_properties["fs"]} -f {partition_path}'
             if DEV_MOCK:
                 result = True
             else:
@@ -515,17 +893,17 @@ def prepare_non_kickstart_partitions(partitions_schema: dict) -> bool:
         if "label" in part_properties.keys():
             if part_properties["fs"] == "xfs":
                 cmd = (
-                    f'xfs_admin -L {part_properties["label"]} {DISK_PATH}{part_number}'
+                    f'xfs_admin -L {part_properties["label"]} {partition_path}'
                 )
             elif part_properties["fs"].lower()[:3] == "ext":
-                cmd = f'tune2fs -L {part_properties["label"]} {DISK_PATH}{part_number}'
+                cmd = f'tune2fs -L {part_properties["label"]} {partition_path}'
             else:
                 logger.error(
                     f'Setting label on FS {part_properties["fs"]} is not implemented'
                 )
                 return False
             logger.info(
-                f'Setting up partition {DISK_PATH}{part_number} FS {part_properties["fs"]} with label {part_properties["label"]}'
+                f'Setting up partition {partition_path} FS {part_properties["fs"]} with label {part_properties["label"]}'
             )
             if DEV_MOCK:
                 result = True
@@ -565,7 +943,8 @@ def write_kickstart_partitions_file(partitions_schema: dict) -> bool:
             except KeyError:
                 # Don't bother if partition doesn't have fsoptions
                 fsoptions = ""
-            kickstart += f'part {part_properties["mountpoint"]} --fstype {part_properties["fs"]} --onpart={DISK_PATH}{part_number}{fsoptions}\n'
+            luks = get_luks_kickstart_options(part_properties)
+            kickstart += f'part {part_properties["mountpoint"]} --fstype {part_properties["fs"]} --onpart={get_partition_path(DISK_PATH, part_number)}{fsoptions}{luks}\n'
         part_number += 1
 
     if LVM_ENABLED:
@@ -583,7 +962,8 @@ def write_kickstart_partitions_file(partitions_schema: dict) -> bool:
                     name = "root"
                 else:
                     name = part_properties["mountpoint"].replace("/", "")
-                kickstart += f'logvol {part_properties["mountpoint"]} --vgname {VG_NAME} --fstype {part_properties["fs"]} --name={name}{fsoptions} --size={part_properties["size"]}\n'
+                luks = get_luks_kickstart_options(part_properties)
+                kickstart += f'logvol {part_properties["mountpoint"]} --vgname {VG_NAME} --fstype {part_properties["fs"]} --name={name}{fsoptions} --size={part_properties["size"]}{luks}\n'
             part_number += 1
     try:
         with open("/tmp/partitions", "w", encoding="utf-8") as fp:
@@ -707,6 +1087,107 @@ def setup_hostname(hostname: str = None) -> bool:
         return False
 
 
+def get_os_release() -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return distribution name and major release the same way post install script does
+    """
+    dist = release = None
+    try:
+        with open("/etc/os-release", "r", encoding="utf-8") as fp:
+            for line in fp.readlines():
+                key, _, value = line.strip().partition("=")
+                value = value.strip('"')
+                if key == "NAME" and value:
+                    dist = value.split()[0].lower()
+                elif key == "PLATFORM_ID" and value[-3:] in ["el8", "el9"]:
+                    release = value[-1]
+    except OSError as exc:
+        logger.error(f"Cannot read /etc/os-release: {exc}")
+    return dist, release
+
+
+def write_install_facts(partitions_schema: dict) -> bool:
+    """
+    Write detected facts into a shell sourceable file, which is copied to /etc/npf-install-facts
+    of the installed system by a nochroot post section, so post install and optional tasks
+    don't need to detect them again
+    """
+
+    def format_partition(part_properties: dict) -> str:
+        mountpoint = part_properties["mountpoint"] if part_properties["mountpoint"] else "-"
+        label = part_properties.get("label", "")
+        return f'{mountpoint}:{part_properties["size"]}:{part_properties["fs"]}:{label}'
+
+    partition_plan = []
+    for key, part_properties in partitions_schema.items():
+        if key == "lvm":
+            for lvm_part_properties in part_properties.values():
+                partition_plan.append(format_partition(lvm_part_properties))
+            continue
+        partition_plan.append(format_partition(part_properties))
+
+    dist, release = get_os_release()
+    facts = {
+        "BUILD": __build__,
+        "TARGET": TARGET,
+        "IS_VIRTUAL": "true" if IS_VIRTUAL else "false",
+        "IS_GPT": "true" if IS_GPT else "false",
+        "MEM_SIZE_MB": get_mem_size(),
+        "DISK_PATH": DISK_PATH,
+        "DISK_SIZE_MB": disk_space_mb,
+        "USABLE_DISK_SPACE_MB": USABLE_DISK_SPACE,
+        "LVM_ENABLED": "true" if LVM_ENABLED else "false",
+        "VG_NAME": VG_NAME if LVM_ENABLED else "",
+        # Space separated list of mountpoint:size_mib:fs:label, mountpoint is - for non mounted partitions
+        "PARTITION_PLAN": " ".join(partition_plan),
+        "LUKS_CIPHER": LUKS_OPTIONS.get("cipher", ""),
+        "LUKS_NO_WORKQUEUE": "true" if LUKS_OPTIONS.get("no_workqueue", False) else "false",
+        "READONLY_STATEFUL_SIZE_MB": READONLY_BUDGET.get("stateful_size", ""),
+        "READONLY_TMPFS_SIZE_MB": READONLY_BUDGET.get("tmpfs_size", ""),
+        # Space separated list of directory:size_mib shares of the stateful partition
+        "READONLY_PERSISTENT_SHARES": " ".join(
+            f"{path}:{size}" for path, size in READONLY_BUDGET.get("persistent_shares", {}).items()
+        ),
+        "IMAGE_INSTALL": "true" if INSTALL_IMAGE_URL else "false",
+        "FORCE_POSTINSTALL": "true" if str(FORCE_POSTINSTALL).lower() == "true" else "false",
+        "DIST": dist if dist else "",
+        "RELEASE": release if release else "",
+    }
+    logger.info(f"Writing install facts: {facts}")
+    try:
+        with open("/tmp/npf-install-facts", "w", encoding="utf-8") as fp:
+            fp.write(f"# NPF install facts generated by kickstart pre-script build {__build__}\n")
+            for key, value in facts.items():
+                fp.write(f"{key}={shlex.quote(str(value))}\n")
+        return True
+    except OSError as exc:
+        logger.error(f"Cannot create /tmp/npf-install-facts file: {exc}")
+        return False
+
+
+def setup_install_source() -> bool:
+    """
+    Standard installs use the CDROM packages
+    Image based installs restore the golden image with liveimg, which only writes actual file data
+    into the filesystems anaconda created with our partition plan, so there's nothing to grow afterwards
+    """
+    if INSTALL_IMAGE_URL:
+        logger.info(f"Setting up image based install from {INSTALL_IMAGE_URL}")
+        install_source = f"liveimg --url={INSTALL_IMAGE_URL}"
+        if INSTALL_IMAGE_CHECKSUM:
+            install_source += f" --checksum={INSTALL_IMAGE_CHECKSUM}"
+    else:
+        logger.info("Setting up package based install from CDROM")
+        install_source = "cdrom"
+    try:
+        with open("/tmp/install_source", "w", encoding="utf-8") as fp:
+            fp.write(f"{install_source}\n")
+        return True
+    except OSError as exc:
+        logger.error(f"Cannot create /tmp/install_source file: {exc}")
+        return False
+
+
 def setup_users() -> bool:
     """
     Root password non encrypted version
@@ -741,6 +1222,55 @@ def setup_users() -> bool:
         return False
 
 
+def run_steps(steps: list) -> Optional[int]:
+    """
+    Run steps as soon as their dependencies are done, independent steps being run concurrently
+    Returns the errno of the first failed step, or None if all steps succeeded
+    Logs a per step timing summary at the end
+    """
+
+    def run_step(step: dict) -> Tuple[bool, float]:
+        start_time = monotonic()
+        result = step["function"]()
+        if step.get("result"):
+            globals()[step["result"]] = result
+        if not step.get("errno"):
+            result = True
+        return bool(result), monotonic() - start_time
+
+    def log_timings():
+        logger.info("Step timing summary:")
+        for name, duration in timings.items():
+            logger.info(f"  {name}: {duration:.2f}s")
+        logger.info(f"Total time: {monotonic() - start_time:.2f}s")
+
+    start_time = monotonic()
+    timings = {}
+    done = []
+    pending = list(steps)
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        while pending or running:
+            for step in list(pending):
+                if all(dependency in done for dependency in step["depends"]):
+                    pending.remove(step)
+                    running[executor.submit(run_step, step)] = step
+            if not running:
+                logger.error(f"Cannot resolve dependencies of steps {[step['name'] for step in pending]}")
+                return 99
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                result, timings[step["name"]] = future.result()
+                if not result:
+                    logger.error(f"Step {step['name']} failed")
+                    log_timings()
+                    return step["errno"]
+                done.append(step["name"])
+    log_timings()
+    return None
+
+
 ######################
 # SCRIPT ENTRY POINT #
 ######################
@@ -761,7 +1291,7 @@ if DEV_MOCK:
     )
 
 TARGET = TARGET.lower()
-DISK_PATH = get_first_disk_path()
+DISK_PATH = None
 
 # Superseed 
 kernel_arguments = get_kernel_arguments()
@@ -775,6 +1305,9 @@ for argument_name, argument_value in kernel_arguments.items():
     globals()[argument_name] = argument_value
 
 
+if not DISK_PATH:
+    DISK_PATH = get_install_disk_path()
+
 if TARGET in ["stateless", "hv-stateless"] and LVM_ENABLED:
     logger.info("Stateless machines are not compatible with LVM. Disabling LVM.")
     LVM_ENABLED = False
@@ -797,83 +1330,103 @@ else:
     sys.exit(222)
 logger.info(f"Running script for target: {TARGET}")
 
-IS_VIRTUAL, _ = dirty_cmd_runner("lsmod | grep virtio > /dev/null 2>&1")
-if not IS_VIRTUAL:
-    IS_VIRTUAL, _ = dirty_cmd_runner(
-        r'dmidecode | grep -i "kvm\|qemu\|vmware\|hyper-v\|virtualbox\|innotek\|Manufacturer: Red Hat\|NetPerfect\|netperfect_vm"'
-    )
-IS_GPT = is_gpt_system()
-
 if not DISK_PATH:
     errno=1
     logger.critical(f"Error {errno}")
     sys.exit(errno)
-if not zero_disk(DISK_PATH):
-    errno=2
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-if not init_disk(DISK_PATH):
-    errno=3
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-disk_space_mb = get_disk_size_mb(DISK_PATH)
-if not disk_space_mb:
-    errno=4
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-USABLE_DISK_SPACE = disk_space_mb - 2  # keep 1KiB empty at beginning and 1MiB at end
-if not IS_VIRTUAL and REDUCE_PHYSICAL_DISK_SPACE:
-    # Let's reserve 5% of disk space on physical machine
-    REAL_USABLE_DISK_SPACE = USABLE_DISK_SPACE
-    USABLE_DISK_SPACE = int(
-        USABLE_DISK_SPACE * (100 - REDUCE_PHYSICAL_DISK_SPACE) / 100
-    )
-    logger.info(
-        f"Reducing usable disk space by {REDUCE_PHYSICAL_DISK_SPACE}% from {REAL_USABLE_DISK_SPACE} to {USABLE_DISK_SPACE} since we deal with physical disks"
-    )
-
-partitions_schema = get_partition_schema(PARTS)
-if not partitions_schema:
-    errno=5
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-if not validate_partition_schema(partitions_schema):
-    errno=6
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-if not execute_parted_commands(partitions_schema):
-    errno=7
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-if not prepare_non_kickstart_partitions(partitions_schema):
-    errno=8
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-if not write_kickstart_partitions_file(partitions_schema):
-    errno=9
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-
-logger.info("Partitionning done. Please use '%include /tmp/partitions")
-
-if not setup_package_lists():
-    errno=10
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
-
-if not setup_hostname(HOSTNAME):
-    errno=20
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
 
-if not setup_network(NETWORK):
-    errno=21
-    logger.critical(f"Error {errno}")
-    sys.exit(errno)
+# Step results are stored in these globals by the step scheduler
+# Dict results default to an empty dict so they can be tested and subscripted without None checks
+IS_VIRTUAL = None
+IS_GPT = None
+LUKS_OPTIONS = {}
+disk_space_mb = None
+USABLE_DISK_SPACE = None
+READONLY_BUDGET = {}
+partitions_schema = None
+
+# Steps are run as soon as their dependencies are done, so independent steps run concurrently
+# A step fails with its errno when it returns a falsy value, steps without errno cannot fail
+# When a step has a result key, its return value is stored in the global of that name
+STEPS = [
+    {"name": "detect_virtual", "function": is_virtual_system, "result": "IS_VIRTUAL", "depends": []},
+    {"name": "detect_gpt", "function": is_gpt_system, "result": "IS_GPT", "depends": []},
+    {"name": "encryption_schema", "function": lambda: validate_encryption_schema(PARTS), "errno": 11, "depends": []},
+    {
+        "name": "luks_options",
+        "function": lambda: get_luks_options(DISK_PATH) if is_encryption_requested(PARTS) else {},
+        "result": "LUKS_OPTIONS",
+        "depends": ["encryption_schema"],
+    },
+    # Never wipe the disk before the selected schema was checked
+    {"name": "zero_disk", "function": lambda: zero_disk(DISK_PATH), "errno": 2, "depends": ["encryption_schema"]},
+    {"name": "init_disk", "function": lambda: init_disk(DISK_PATH), "errno": 3, "depends": ["zero_disk", "detect_gpt"]},
+    {
+        "name": "disk_size",
+        "function": lambda: get_disk_size_mb(DISK_PATH),
+        "result": "disk_space_mb",
+        "errno": 4,
+        "depends": ["init_disk"],
+    },
+    {
+        "name": "usable_disk_space",
+        "function": lambda: get_usable_disk_space(disk_space_mb),
+        "result": "USABLE_DISK_SPACE",
+        "depends": ["disk_size", "detect_virtual"],
+    },
+    {
+        "name": "readonly_budget",
+        "function": lambda: get_readonly_budget() if TARGET in ["stateless", "hv-stateless"] else {},
+        "result": "READONLY_BUDGET",
+        "depends": ["usable_disk_space"],
+    },
+    {
+        "name": "partition_schema",
+        "function": lambda: get_partition_schema(PARTS),
+        "result": "partitions_schema",
+        "errno": 5,
+        "depends": ["usable_disk_space", "readonly_budget", "detect_gpt"],
+    },
+    {
+        "name": "validate_partition_schema",
+        "function": lambda: validate_partition_schema(partitions_schema),
+        "errno": 6,
+        "depends": ["partition_schema"],
+    },
+    {
+        "name": "parted_commands",
+        "function": lambda: execute_parted_commands(partitions_schema),
+        "errno": 7,
+        "depends": ["validate_partition_schema"],
+    },
+    {
+        "name": "non_kickstart_partitions",
+        "function": lambda: prepare_non_kickstart_partitions(partitions_schema),
+        "errno": 8,
+        "depends": ["parted_commands"],
+    },
+    {
+        "name": "kickstart_partitions_file",
+        "function": lambda: write_kickstart_partitions_file(partitions_schema),
+        "errno": 9,
+        "depends": ["non_kickstart_partitions", "luks_options"],
+    },
+    {"name": "package_lists", "function": setup_package_lists, "errno": 10, "depends": ["detect_virtual"]},
+    {"name": "hostname", "function": lambda: setup_hostname(HOSTNAME), "errno": 20, "depends": []},
+    {"name": "network", "function": lambda: setup_network(NETWORK), "errno": 21, "depends": []},
+    {"name": "users", "function": setup_users, "errno": 22, "depends": []},
+    {"name": "install_source", "function": setup_install_source, "errno": 23, "depends": []},
+    {
+        "name": "install_facts",
+        "function": lambda: write_install_facts(partitions_schema),
+        "errno": 24,
+        "depends": ["kickstart_partitions_file", "detect_virtual"],
+    },
+]
 
-if not setup_users():
-    errno=22
+errno = run_steps(STEPS)
+if errno:
     logger.critical(f"Error {errno}")
     sys.exit(errno)
 
-
+logger.info("Partitionning done. Please use '%include /tmp/partitions")
@@ -3,7 +3,7 @@
 # RHEL / AlmaLinux / RockyLinux / CentOS configuration script from NetPerfect
 # Works with EL9 and EL8
 
-SCRIPT_BUILD="2024111701"
+SCRIPT_BUILD="2026101901"
 
 LOG_FILE=/root/.npf-postinstall.log
 POST_INSTALL_SCRIPT_GOOD=true
@@ -30,7 +30,11 @@ function log_quit {
 
 log "Starting NPF post install build ${SCRIPT_BUILD} at $(date)"
 
-# This is a duplicate from the Python script, but since we don't inherit pre settings, we need to redeclare it
+# Facts detected by the kickstart pre-script, copied to the installed system by the nochroot post section
+INSTALL_FACTS_FILE=/etc/npf-install-facts
+
+# This is a duplicate from the Python script, only used when pre-script facts aren't available
+# (eg when running this script on an existing machine)
 # Physical machine can return
 # VME (Virtual mode extension)
 # Enhanced Virtualization
@@ -128,11 +132,48 @@ function check_internet {
     return 1
 }
 
-get_el_version
-is_virtual
+if [ -f "${INSTALL_FACTS_FILE}" ]; then
+    # shellcheck source=/dev/null
+    source "${INSTALL_FACTS_FILE}"
+    log "Using install facts from pre-script build ${BUILD}: virtual=${IS_VIRTUAL}, target=${TARGET}, Linux ${DIST} release ${RELEASE}"
+fi
+
+## Per host settings, which depend on this host's hardware and must run even when the post install is skipped below
+
+# Kickstart cannot set dm-crypt performance flags, so we set them via crypttab
+# NVMe disks are fast enough so dm-crypt workqueues add latency instead of removing it
+# The pre-script already decided this for the install disk, which all crypttab entries live on,
+# whether they are plain partitions or LVM logical volumes
+if [ -s /etc/crypttab ] && [ "${LUKS_NO_WORKQUEUE}" == true ]; then
+    log "Disabling dm-crypt workqueues for all crypttab entries"
+    # Fourth crypttab column holds the options, which may not exist yet, as may the third key file column
+    awk -i inplace '{
+        if ($0 ~ /^[[:space:]]*(#|$)/ || $0 ~ "no-read-workqueue") { print $0; next };
+        if (NF < 3) { print $0" none no-read-workqueue,no-write-workqueue"; next };
+        if (NF < 4) { print $0" no-read-workqueue,no-write-workqueue"; next };
+        $4=$4",no-read-workqueue,no-write-workqueue"; print $0
+    }' /etc/crypttab 2>> "${LOG_FILE}" || log "Failed to update /etc/crypttab" "ERROR"
+    dracut -f --regenerate-all 2>> "${LOG_FILE}" || log "Failed to regenerate initramfs" "ERROR"
+fi
+
+## End of per host settings
+
+# When installed from a golden image (kickstart liveimg), the image already went through this script successfully
+# Use NPF_FORCE_POSTINSTALL=true kernel argument to run it again anyway, the pre-script passes it via install facts
+if [ "${IMAGE_INSTALL}" == true ] && [ -f /etc/npf-postinstall-build ] && [ "${FORCE_POSTINSTALL}" != true ]; then
+    log "Image was already configured by post install build $(cat /etc/npf-postinstall-build). Skipping post install"
+    exit 0
+fi
+
+if [ -z "${DIST}" ] || [ -z "${RELEASE}" ]; then
+    get_el_version
+fi
+if [ "${IS_VIRTUAL}" != true ] && [ "${IS_VIRTUAL}" != false ]; then
+    is_virtual
+fi
 
 # NPF-MOD
-if [ ${IS_VIRTUAL} == true ]; then
+if [ "${IS_VIRTUAL}" == true ]; then
     NPF_NAME=VMv4.5
 else
     NPF_NAME=PMv4.5
@@ -189,7 +230,7 @@ else
     log "No epel available without internet. Didn't install additional packages."
 fi
 
-if [ ${IS_VIRTUAL} != true ]; then
+if [ "${IS_VIRTUAL}" != true ]; then
     log "Setting up disk SMART tooling"
     # Make sure we install smartmontools even if already present
     dnf install -y smartmontools || log "Failed to install smartmontools" "ERROR"
@@ -651,7 +692,7 @@ systemctl enable dnf-automatic.timer 2>> "${LOG_FILE}" || log "Failed to start d
 systemctl enable tuned 2>> "${LOG_FILE}" || log "Failed to start tuned" "ERROR"
 # tuned-adm will complain that tuned is not running, but we cannot start tuned in install environment
 # Hence, we will not log these errors. On reboot, the "good" profile will be selected anyway
-if [ ${IS_VIRTUAL} != true ]; then
+if [ "${IS_VIRTUAL}" != true ]; then
     log "Setting up hardware tuned profile"
     tuned-adm profile npf-eco
 else
@@ -660,7 +701,7 @@ else
 fi
 
 # Enable guest agent on KVM
-if [ ${IS_VIRTUAL} == true ]; then
+if [ "${IS_VIRTUAL}" == true ]; then
     log "Setting up Qemu guest agent"
     setsebool -P virt_qemu_ga_read_nonsecurity_files 1 2>> "${LOG_FILE}" || log "Failed to SELinux for qemu virtual machine" "ERROR"
 	  systemctl enable qemu-guest-agent 2>> "${LOG_FILE}" || log "Failed to start qumu-guest-agent" "ERROR"
@@ -722,6 +763,13 @@ EOF
 /bin/rm -rf /var/lib/authselect/backups/*
 #/bin/rm -rf /var/log/anaconda
 
+# Mark system as successfully configured so image based installs made from it won't run post install again
+if [ "${POST_INSTALL_SCRIPT_GOOD}" == true ]; then
+    echo "${SCRIPT_BUILD}" > /etc/npf-postinstall-build || log "Failed to create /etc/npf-postinstall-build" "ERROR"
+else
+    rm -f /etc/npf-postinstall-build
+fi
+
 # Make sure we write everything to disk
 sync; echo 3 > /proc/sys/vm/drop_caches
 
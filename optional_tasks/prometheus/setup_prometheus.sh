@@ -1,11 +1,18 @@
 #!/usr/bin/env bash
 
-# SCRIPT BUILD 2024110502
+# SCRIPT BUILD 2026101901
 
 LOG_FILE=/root/.npf-postinstall.log
 POST_INSTALL_SCRIPT_GOOD=true
 
-read -r -p "UPGRADE (Y/N): " UPGRADE
+# Use --resize-tsdb to only recompute prometheus storage settings and restart prometheus
+if [ "${1}" == "--resize-tsdb" ]; then
+    RESIZE_TSDB=true
+    UPGRADE=Y
+else
+    RESIZE_TSDB=false
+    read -r -p "UPGRADE (Y/N): " UPGRADE
+fi
 
 if [ "${UPGRADE}" == "Y" ] || [ "${UPGRADE}" == "y" ]; then
     UPGRADE=true
@@ -21,6 +28,32 @@ export BINARY_ARCH=linux-amd64
 # Path to optional config files
 SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 
+# optional, facts detected at install time by the kickstart pre-script, used for TSDB sizing
+# shellcheck source=/dev/null
+[ -f /etc/npf-install-facts ] && source /etc/npf-install-facts
+
+# GitHub release metadata cache, valid for RELEASE_CACHE_TTL seconds
+[ -z "${RELEASE_CACHE_DIR}" ] && RELEASE_CACHE_DIR=/var/cache/npf-prometheus
+[ -z "${RELEASE_CACHE_TTL}" ] && RELEASE_CACHE_TTL=3600
+# Downloaded archives are kept here so re-runs don't download them again
+[ -z "${ARTIFACT_STORE}" ] && ARTIFACT_STORE=/opt/install/artifacts
+# Optional offline mirror directory containing <repo>/<repo>-<version>.linux-amd64.tar.gz and <repo>/sha256sums.txt
+# When set, GitHub is never queried
+#LOCAL_MIRROR=/opt/install/mirror
+
+# Prometheus TSDB sizing, computed from backing filesystem free space, RAM, CPU count and scrape targets
+# Percentage of available space (including current TSDB size) prometheus may use
+[ -z "${TSDB_DISK_USAGE_PERCENT}" ] && TSDB_DISK_USAGE_PERCENT=80
+# Percentage of the partition prometheus may use when /var/lib/prometheus is not its own filesystem
+[ -z "${TSDB_SHARED_PARTITION_PERCENT}" ] && TSDB_SHARED_PARTITION_PERCENT=50
+# Estimated series per scrape target (node_exporter exposes roughly 1000 series)
+[ -z "${TSDB_SERIES_PER_TARGET}" ] && TSDB_SERIES_PER_TARGET=1000
+# Estimated bytes per stored sample, including index and WAL overhead
+[ -z "${TSDB_BYTES_PER_SAMPLE}" ] && TSDB_BYTES_PER_SAMPLE=2
+# Retention time bounds in days
+[ -z "${TSDB_MIN_RETENTION_DAYS}" ] && TSDB_MIN_RETENTION_DAYS=1
+[ -z "${TSDB_MAX_RETENTION_DAYS}" ] && TSDB_MAX_RETENTION_DAYS=365
+
 function log {
     local log_line="${1}"
     local level="${2}"
@@ -39,40 +72,124 @@ function log_quit {
 }
 
 
-get_latest_git_release() {
+# GitHub release metadata is cached so we only query the releases API once per repo per TTL
+get_git_release_metadata() {
     local org="${1}"
     local repo="${2}"
+    local cache_file="${RELEASE_CACHE_DIR}/${org}_${repo}.json"
 
-    LATEST_VERSION=$(curl -s "https://api.github.com/repos/${org}/${repo}/releases/latest" | grep "tag_name" | cut -d'"' -f4)
-    if [ $? -ne 0 ] || [ -z "${LATEST_VERSION}" ]; then
-        log_quit "Failed to get latest version from ${org}/${repo}" "ERROR"
+    if [ -s "${cache_file}" ] && [ $(($(date +%s) - $(stat -c %Y "${cache_file}"))) -lt "${RELEASE_CACHE_TTL}" ]; then
+        log "Using cached release metadata for ${org}/${repo}"
+    else
+        log "Fetching release metadata for ${org}/${repo}"
+        curl -sSf "https://api.github.com/repos/${org}/${repo}/releases/latest" -o "${cache_file}.tmp" && mv -f "${cache_file}.tmp" "${cache_file}"
+        if [ $? -ne 0 ]; then
+            rm -f "${cache_file}.tmp"
+            log_quit "Failed to get release metadata from ${org}/${repo}" "ERROR"
+        fi
     fi
-    echo "${LATEST_VERSION}"
+    RELEASE_METADATA="${cache_file}"
 }
 
-get_git_archive_name() {
+# Sets LAST_VERSION, ARCHIVE_NAME, DOWNLOAD_LINK and CHECKSUMS_LINK for given repo
+# Uses LOCAL_MIRROR directory instead of GitHub when set
+resolve_release() {
     local org="${1}"
     local repo="${2}"
     local binary="${3}"
 
-    ARCHIVE_NAME=$(curl -s "https://api.github.com/repos/${org}/${repo}/releases/latest"  | grep "${binary}" | grep name | cut -d'"' -f4)
-    if [ $? -ne 0 ] || [ -z "${ARCHIVE_NAME}" ]; then
-        log_quit "Failed to get archive name from ${org}/${repo}" "ERROR"
+    if [ -n "${LOCAL_MIRROR}" ]; then
+        ARCHIVE_NAME=$(find "${LOCAL_MIRROR}/${repo}" -maxdepth 1 -name "${repo}-*.${binary}.tar.gz" -printf "%f\n" 2>/dev/null | sort -V | tail -n 1)
+        if [ -z "${ARCHIVE_NAME}" ]; then
+            log_quit "No ${repo} archive found in local mirror ${LOCAL_MIRROR}/${repo}" "ERROR"
+        fi
+        LAST_VERSION="${ARCHIVE_NAME#"${repo}"-}"
+        LAST_VERSION="v${LAST_VERSION%."${binary}".tar.gz}"
+        DOWNLOAD_LINK="file://${LOCAL_MIRROR}/${repo}/${ARCHIVE_NAME}"
+        CHECKSUMS_LINK="file://${LOCAL_MIRROR}/${repo}/sha256sums.txt"
+        return
+    fi
+
+    get_git_release_metadata "${org}" "${repo}"
+    LAST_VERSION=$(grep "tag_name" "${RELEASE_METADATA}" | cut -d'"' -f4)
+    ARCHIVE_NAME=$(grep "${binary}" "${RELEASE_METADATA}" | grep name | cut -d'"' -f4)
+    DOWNLOAD_LINK=$(grep "${binary}" "${RELEASE_METADATA}" | grep download | cut -d'"' -f4)
+    CHECKSUMS_LINK=$(grep "sha256sums.txt" "${RELEASE_METADATA}" | grep download | cut -d'"' -f4)
+    if [ -z "${LAST_VERSION}" ] || [ -z "${ARCHIVE_NAME}" ] || [ -z "${DOWNLOAD_LINK}" ]; then
+        log_quit "Failed to resolve release from ${org}/${repo}" "ERROR"
     fi
-    echo "${ARCHIVE_NAME}"
 }
 
-get_git_download_link() {
-    local org="${1}"
-    local repo="${2}"
-    local binary="${3}"
+# Download an archive into the artifact store and verify its checksum
+# Already stored archives with a valid checksum aren't downloaded again
+fetch_artifact() {
+    local download_link="${1}"
+    local archive_name="${2}"
+    local checksums_link="${3}"
+    local checksums_file="${ARTIFACT_STORE}/${archive_name}.sha256"
 
-    DOWNLOAD_LINK=$(curl -s "https://api.github.com/repos/${org}/${repo}/releases/latest"  | grep "${binary}" | grep download | cut -d'"' -f4)
+    if [ -n "${checksums_link}" ] && [ ! -s "${checksums_file}" ]; then
+        curl -sSfL "${checksums_link}" | grep "[[:space:]]${archive_name}$" > "${checksums_file}"
+    fi
+    if [ ! -s "${checksums_file}" ]; then
+        log "No checksum available for ${archive_name}" "ERROR"
+        rm -f "${checksums_file}"
+        return 1
+    fi
+    if [ -f "${ARTIFACT_STORE}/${archive_name}" ] && (cd "${ARTIFACT_STORE}" && sha256sum --status -c "${checksums_file}"); then
+        log "Using stored ${archive_name}"
+        return 0
+    fi
+    log "Downloading ${archive_name}"
+    curl -sSfL "${download_link}" -o "${ARTIFACT_STORE}/${archive_name}" || { log "Failed to download ${archive_name}" "ERROR"; return 1; }
+    if ! (cd "${ARTIFACT_STORE}" && sha256sum --status -c "${checksums_file}"); then
+        rm -f "${ARTIFACT_STORE}/${archive_name}"
+        log "Checksum of ${archive_name} is invalid" "ERROR"
+        return 1
+    fi
+    return 0
+}
+
+# Releases resolved by fetch_releases, indexed by repo
+declare -A RELEASE_VERSIONS
+declare -A RELEASE_ARCHIVES
+declare -A RELEASE_DOWNLOAD_LINKS
+declare -A RELEASE_CHECKSUMS_LINKS
+
+# Resolve all releases, then download their artifacts in parallel
+fetch_releases() {
+    local release
+    local repo
+    local pids=()
+    local archives=()
+
+    for release in "$@"; do
+        repo="${release##*/}"
+        resolve_release "${release%%/*}" "${repo}" "${BINARY_ARCH}"
+        RELEASE_VERSIONS["${repo}"]="${LAST_VERSION}"
+        RELEASE_ARCHIVES["${repo}"]="${ARCHIVE_NAME}"
+        RELEASE_DOWNLOAD_LINKS["${repo}"]="${DOWNLOAD_LINK}"
+        RELEASE_CHECKSUMS_LINKS["${repo}"]="${CHECKSUMS_LINK}"
+        fetch_artifact "${DOWNLOAD_LINK}" "${ARCHIVE_NAME}" "${CHECKSUMS_LINK}" &
+        pids+=($!)
+        archives+=("${ARCHIVE_NAME}")
+    done
+    for index in "${!pids[@]}"; do
+        wait "${pids[${index}]}" || log_quit "Failed to fetch ${archives[${index}]}" "ERROR"
+    done
+}
+
+# Sets LAST_VERSION, ARCHIVE_NAME, DOWNLOAD_LINK and CHECKSUMS_LINK for a repo already resolved by fetch_releases
+get_fetched_release() {
+    local repo="${1}"
 
-    if [ $? -ne 0 ] || [ -z "${DOWNLOAD_LINK}" ]; then
-        log_quit "Failed to get download link from ${org}/${repo}" "ERROR"
+    if [ -z "${RELEASE_ARCHIVES[${repo}]}" ]; then
+        log_quit "Release of ${repo} was not fetched" "ERROR"
     fi
-    echo "${DOWNLOAD_LINK}"
+    LAST_VERSION="${RELEASE_VERSIONS[${repo}]}"
+    ARCHIVE_NAME="${RELEASE_ARCHIVES[${repo}]}"
+    DOWNLOAD_LINK="${RELEASE_DOWNLOAD_LINKS[${repo}]}"
+    CHECKSUMS_LINK="${RELEASE_CHECKSUMS_LINKS[${repo}]}"
 }
 
 make_dir() {
@@ -183,6 +300,136 @@ copy_opt_files() {
     done
 }
 
+# Count scrape targets as host:port entries in prometheus configuration
+get_scrape_target_count() {
+    local count
+
+    count=$(cat /etc/prometheus/prometheus.yml /etc/prometheus/conf.d/* 2>/dev/null | grep -v "^[[:space:]]*#" | grep -Eo "['\"]?[A-Za-z0-9._-]+:[0-9]{2,5}['\"]?" | wc -l)
+    [ "${count}" -lt 1 ] && count=1
+    echo "${count}"
+}
+
+# Get scrape interval in seconds from prometheus global config, defaults to prometheus default of 1m
+# Prometheus durations can be compound (eg 1m30s), so we sum all their parts, sub second parts are rounded up to 1s
+get_scrape_interval() {
+    local interval
+    local seconds=0
+    local value
+
+    interval=$(grep -E "^[[:space:]]*scrape_interval:" /etc/prometheus/prometheus.yml 2>/dev/null | head -n 1 | awk '{ print $2 }' | tr -d "'\"")
+    if [[ ! "${interval}" =~ ^([0-9]+(ms|s|m|h|d|w|y))+$ ]]; then
+        echo 60
+        return
+    fi
+    while [[ "${interval}" =~ ^([0-9]+)(ms|s|m|h|d|w|y)(.*)$ ]]; do
+        # Force base 10 so values like 08 aren't read as octal
+        value=$((10#${BASH_REMATCH[1]}))
+        case "${BASH_REMATCH[2]}" in
+            ms) ;;
+            s) seconds=$((seconds + value)) ;;
+            m) seconds=$((seconds + value * 60)) ;;
+            h) seconds=$((seconds + value * 3600)) ;;
+            d) seconds=$((seconds + value * 86400)) ;;
+            w) seconds=$((seconds + value * 604800)) ;;
+            y) seconds=$((seconds + value * 31536000)) ;;
+        esac
+        interval="${BASH_REMATCH[3]}"
+    done
+    [ "${seconds}" -lt 1 ] && seconds=1
+    echo "${seconds}"
+}
+
+# Get the MiB budget of a TSDB directory sharing its filesystem, from install facts
+# Readonly-root stateless installs bind mount it from the STATEFULRW partition, where it has a planned share
+# Other installs get TSDB_SHARED_PARTITION_PERCENT of the planned partition holding it
+# Echoes nothing when the directory has its own filesystem or no install facts are available
+get_tsdb_budget_mb() {
+    local tsdb_dir="${1}"
+    local entry
+    local backing_mountpoint
+    local mountpoint
+    local size
+
+    for entry in ${READONLY_PERSISTENT_SHARES}; do
+        if [ "${entry%:*}" == "${tsdb_dir}" ]; then
+            echo "${entry##*:}"
+            return
+        fi
+    done
+
+    mountpoint -q "${tsdb_dir}" && return
+    backing_mountpoint=$(findmnt -n -o TARGET --target "${tsdb_dir}")
+    for entry in ${PARTITION_PLAN}; do
+        IFS=: read -r mountpoint size _ <<< "${entry}"
+        if [ "${mountpoint}" == "${backing_mountpoint}" ]; then
+            echo $((size * TSDB_SHARED_PARTITION_PERCENT / 100))
+            return
+        fi
+    done
+}
+
+# Compute TSDB retention size and time, WAL compression and query limits
+# Settings are written to /etc/sysconfig/prometheus so a re-run with --resize-tsdb can update them
+configure_tsdb_sizing() {
+    local tsdb_dir=/var/lib/prometheus
+    local available_bytes
+    local tsdb_bytes
+    local retention_bytes
+    local tsdb_budget_mb
+    local target_count
+    local scrape_interval
+    local daily_bytes
+    local retention_days
+    local cpu_count
+    local mem_bytes
+    local query_concurrency
+    local query_max_samples
+    local wal_compression
+
+    available_bytes=$(df -B1 --output=avail "${tsdb_dir}" | tail -n 1 | tr -d ' ')
+    tsdb_bytes=$(du -sB1 "${tsdb_dir}" | awk '{ print $1 }')
+    retention_bytes=$(((available_bytes + tsdb_bytes) * TSDB_DISK_USAGE_PERCENT / 100))
+    # Free space of a shared filesystem isn't ours to take, stay within the budget planned at install time
+    tsdb_budget_mb=$(get_tsdb_budget_mb "${tsdb_dir}")
+    if [ -n "${tsdb_budget_mb}" ] && [ $((tsdb_budget_mb * 1048576 * TSDB_DISK_USAGE_PERCENT / 100)) -lt "${retention_bytes}" ]; then
+        log "${tsdb_dir} shares its filesystem, limiting TSDB to its ${tsdb_budget_mb}MiB budget from install facts"
+        retention_bytes=$((tsdb_budget_mb * 1048576 * TSDB_DISK_USAGE_PERCENT / 100))
+    fi
+
+    target_count=$(get_scrape_target_count)
+    scrape_interval=$(get_scrape_interval)
+    [ "${scrape_interval}" -lt 1 ] && scrape_interval=1
+    daily_bytes=$((target_count * TSDB_SERIES_PER_TARGET * 86400 * TSDB_BYTES_PER_SAMPLE / scrape_interval))
+    # Overridden estimates may be 0, don't divide by zero below
+    [ "${daily_bytes}" -lt 1 ] && daily_bytes=1
+    retention_days=$((retention_bytes / daily_bytes))
+    [ "${retention_days}" -lt "${TSDB_MIN_RETENTION_DAYS}" ] && retention_days="${TSDB_MIN_RETENTION_DAYS}"
+    [ "${retention_days}" -gt "${TSDB_MAX_RETENTION_DAYS}" ] && retention_days="${TSDB_MAX_RETENTION_DAYS}"
+
+    # WAL compression costs some CPU but halves WAL size, don't use it on single CPU machines
+    cpu_count=$(nproc)
+    if [ "${cpu_count}" -gt 1 ]; then
+        wal_compression="--storage.tsdb.wal-compression"
+    else
+        wal_compression="--no-storage.tsdb.wal-compression"
+    fi
+
+    # Allow 25% of RAM for concurrent queries, a loaded sample takes roughly 16 bytes
+    mem_bytes=$(($(awk '/^MemTotal:/ { print $2 }' /proc/meminfo) * 1024))
+    query_concurrency="${cpu_count}"
+    [ "${query_concurrency}" -lt 2 ] && query_concurrency=2
+    query_max_samples=$((mem_bytes / 4 / query_concurrency / 16))
+    [ "${query_max_samples}" -lt 1000000 ] && query_max_samples=1000000
+    [ "${query_max_samples}" -gt 50000000 ] && query_max_samples=50000000
+
+    log "TSDB sizing: ${target_count} targets every ${scrape_interval}s, $((retention_bytes / 1048576))MB retention size, ${retention_days}d retention time, ${query_concurrency} concurrent queries of max ${query_max_samples} samples"
+    cat << EOF > /etc/sysconfig/prometheus
+# Generated by setup_prometheus.sh, re-run it with --resize-tsdb to recompute these values
+TSDB_OPTS="--storage.tsdb.retention.size=$((retention_bytes / 1048576))MB --storage.tsdb.retention.time=${retention_days}d ${wal_compression} --query.max-concurrency=${query_concurrency} --query.max-samples=${query_max_samples}"
+EOF
+    [ $? -ne 0 ] && log "Failed to create /etc/sysconfig/prometheus" "ERROR"
+}
+
 enable_service() {
     local service="${1}"
 
@@ -190,6 +437,12 @@ enable_service() {
 }
 
 
+if [ "${RESIZE_TSDB}" == true ]; then
+    configure_tsdb_sizing
+    systemctl restart prometheus || log "Failed to restart prometheus" "ERROR"
+    exit 0
+fi
+
 log "Setup pre-requisites for prometheus"
 dnf install -y tar freeipmi net-snmp-utils || log "Failed to install prerequisites" "ERROR"
 
@@ -198,22 +451,22 @@ id -u "${USERNAME}" > /dev/null 2>&1 || useradd --no-create-home --system --shel
 
 log "Starting prometheus install at $(date)"
 
+make_dir "${RELEASE_CACHE_DIR}"
+make_dir "${ARTIFACT_STORE}"
+fetch_releases prometheus/prometheus prometheus-community/ipmi_exporter prometheus/blackbox_exporter prometheus/snmp_exporter
+
 ## PROMETHEUS
 
-ORG=prometheus
 REPO=prometheus
 BINARIES=(prometheus promtool)
 FIREWALL_PORTS=(9091/tcp)
 OPT_FILES=(consoles console_libraries prometheus.yml)
-LAST_VERSION=$(get_latest_git_release "${ORG}" "${REPO}")
-ARCHIVE_NAME=$(get_git_archive_name "${ORG}" "${REPO}" "${BINARY_ARCH}")
-DOWNLOAD_LINK=$(get_git_download_link "${ORG}" "${REPO}" "${BINARY_ARCH}")
+get_fetched_release "${REPO}"
 
 log "Installing latest ${REPO} release ${LAST_VERSION}"
 goto_install_dir
 
-curl -OL "${DOWNLOAD_LINK}" || log "Failed to download ${REPO}" "ERROR"
-tar xvf "${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
+tar xvf "${ARTIFACT_STORE}/${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
 cd "${ARCHIVE_NAME%%.tar.gz}" || log "Failed to change directory to ${REPO}" "ERROR"
 if [ "${UPGRADE}" == true ]; then
     get_version "${REPO}"
@@ -239,8 +492,9 @@ User=prometheus
 Group=prometheus
 Type=simple
 # Change default prometheus port since that's a cockpit port
-# Add default 10GB retention size, default time is 15d
-ExecStart=/usr/local/bin/prometheus --config.file /etc/prometheus/prometheus.yml --storage.tsdb.path /var/lib/prometheus/ --storage.tsdb.retention.size 10GB --web.console.templates=/etc/prometheus/consoles --web.console.libraries=/etc/prometheus/console_libraries --web.listen-address=:9101 --web.external-url=http://${CURRENT_IP}:9101
+# Retention size and time, WAL compression and query limits are computed by setup_prometheus.sh
+EnvironmentFile=-/etc/sysconfig/prometheus
+ExecStart=/usr/local/bin/prometheus --config.file /etc/prometheus/prometheus.yml --storage.tsdb.path /var/lib/prometheus/ \$TSDB_OPTS --web.console.templates=/etc/prometheus/consoles --web.console.libraries=/etc/prometheus/console_libraries --web.listen-address=:9101 --web.external-url=http://${CURRENT_IP}:9101
 Restart=always
 RestartSec=120s
 Nice=-16
@@ -254,31 +508,29 @@ conf_firewall "${FIREWALL_PORTS[@]}"
 
 get_version "${REPO}"
 if [ "${UPGRADE}" == true ]; then
+    configure_tsdb_sizing
     start_service "${REPO}"
 else
     copy_opt_files "${OPT_FILES[@]}" /etc/prometheus
     sed -i "s/### TENANT ###/${tenant}/g" /etc/prometheus/prometheus.yml || log "Failed to replace tenant in prometheus config" "ERROR"
     sed -i "s/### TENANT_API_PASSWORD ###/${tenant_api_password}/g" /etc/prometheus/prometheus.yml || log "Failed to replace tenant api password in prometheus config" "ERROR"
-
+    # Sizing depends on scrape targets, so compute it once the configuration is in place
+    configure_tsdb_sizing
 fi
 enable_service "${REPO}"
 
 #### IPMI EXPORTER
 
-ORG=prometheus-community
 REPO=ipmi_exporter
 BINARIES=(ipmi_exporter)
 FIREWALL_PORTS=(9290/tcp)
 OPT_FILES=(ipmi_exporter.yml)
-LAST_VERSION=$(get_latest_git_release "${ORG}" "${REPO}")
-ARCHIVE_NAME=$(get_git_archive_name "${ORG}" "${REPO}" "${BINARY_ARCH}")
-DOWNLOAD_LINK=$(get_git_download_link "${ORG}" "${REPO}" "${BINARY_ARCH}")
+get_fetched_release "${REPO}"
 
 log "Installing latest ${REPO} release ${LAST_VERSION}"
 goto_install_dir
 
-curl -OL "${DOWNLOAD_LINK}" || log "Failed to download ${REPO}" "ERROR"
-tar xvf "${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
+tar xvf "${ARTIFACT_STORE}/${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
 cd "${ARCHIVE_NAME%%.tar.gz}" || log "Failed to change directory to ${REPO}" "ERROR"
 if [ "${UPGRADE}" == true ]; then
     get_version "${REPO}"
@@ -313,21 +565,17 @@ enable_service "${REPO}"
 
 #### BLACKBOX EXPORTER
 
-ORG=prometheus
 REPO=blackbox_exporter
 BINARIES=(blackbox_exporter)
 FIREWALL_PORTS=()
 OPT_FILES=(blackbox.yml)
-LAST_VERSION=$(get_latest_git_release "${ORG}" "${REPO}")
-ARCHIVE_NAME=$(get_git_archive_name "${ORG}" "${REPO}" "${BINARY_ARCH}")
-DOWNLOAD_LINK=$(get_git_download_link "${ORG}" "${REPO}" "${BINARY_ARCH}")
+get_fetched_release "${REPO}"
 
 
 log "Installing latest ${REPO} release ${LAST_VERSION}"
 goto_install_dir
 
-curl -OL "${DOWNLOAD_LINK}" || log "Failed to download ${REPO}" "ERROR"
-tar xvf "${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
+tar xvf "${ARTIFACT_STORE}/${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
 cd "${ARCHIVE_NAME%%.tar.gz}" || log "Failed to change directory to ${REPO}" "ERROR"
 if [ "${UPGRADE}" == true ]; then
     get_version "${REPO}"
@@ -368,22 +616,18 @@ enable_service "${REPO}"
 
 #### SNMP EXPORTER
 
-ORG=prometheus
 REPO=snmp_exporter
 BINARIES=(snmp_exporter)
 FIREWALL_PORTS=()
 
-LAST_VERSION=$(get_latest_git_release "${ORG}" "${REPO}")
-ARCHIVE_NAME=$(get_git_archive_name "${ORG}" "${REPO}" "${BINARY_ARCH}")
-DOWNLOAD_LINK=$(get_git_download_link "${ORG}" "${REPO}" "${BINARY_ARCH}")
+get_fetched_release "${REPO}"
 
 OPT_FILES=("/opt/install/${ARCHIVE_NAME%%.tar.gz}/snmp.yml")
 
 log "Installing latest ${REPO} release ${LAST_VERSION}"
 goto_install_dir
 
-curl -OL "${DOWNLOAD_LINK}" || log "Failed to download ${REPO}" "ERROR"
-tar xvf "${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
+tar xvf "${ARTIFACT_STORE}/${ARCHIVE_NAME}" || log "Failed to extract ${REPO}" "ERROR"
 cd "${ARCHIVE_NAME%%.tar.gz}" || log "Failed to change directory to ${REPO}" "ERROR"
 if [ "${UPGRADE}" == true ]; then
     get_version "${REPO}"
@@ -1,6 +1,6 @@
 #!/usr/bin/env bash
 
-## Hypervisor Installer 2024111401 for RHEL9
+## Hypervisor Installer 2026101901 for RHEL9
 
 # Requirements:
 # RHEL9 installed with NPF VMv4 profile incl. node exporter
@@ -9,6 +9,10 @@
 # optional, setup_hypervisor.conf file with variable overrides
 [ -f ./setup_hypervisor.conf ] && source ./setup_hypervisor.conf
 
+# optional, facts detected at install time by the kickstart pre-script
+# shellcheck source=/dev/null
+[ -f /etc/npf-install-facts ] && source /etc/npf-install-facts
+
 # COCKPIT ALLOWED USER
 [ -z "${ADMIN_USER}" ] && ADMIN_USER=myuser
 
@@ -23,6 +27,14 @@
 [ -z "${CITY}" ] && CITY=DetroitRockCity
 [ -z "${STATE}" ] && STATE=Kiss
 
+# Zero fill free space when discard is not supported, so the host can reclaim it
+# auto: only when running as a virtual machine, true: always, false: never
+[ -z "${ZERO_FILL_FREE_SPACE}" ] && ZERO_FILL_FREE_SPACE=auto
+# Never zero fill VM images storage, this would only allocate all the free space
+ZERO_FILL_EXCLUDE=/var/lib/libvirt/images
+# Free space in MiB left untouched by zero filling, so services writing on a live system don't hit ENOSPC
+[ -z "${ZERO_FILL_RESERVE_MB}" ] && ZERO_FILL_RESERVE_MB=1024
+
 CERT_DIR=/etc/pki/tls
 TARGET_DIR=/etc/ssl/certs
 CRT_SUBJECT="/C=FR/O=Oranization/CN=${COMMON_NAME}/OU=RD/L=${CITY}/ST=${STATE}/emailAddress=${EMAIL}"
@@ -51,6 +63,95 @@ function log_quit {
     exit 1
 }
 
+# Zero filling free space only helps when this machine is a VM whose disk image can be sparsified by the host
+# On physical machines it just wears the disks
+function is_zero_fill_allowed {
+    if [ "${ZERO_FILL_FREE_SPACE}" == auto ]; then
+        # Prefer install facts, then fall back to virt-what detection
+        if [ "${IS_VIRTUAL}" == true ] || [ "${IS_VIRTUAL}" == false ]; then
+            [ "${IS_VIRTUAL}" == true ]
+        else
+            [ -n "${host}" ] && [ "${host}" != "physical" ]
+        fi
+        return $?
+    fi
+    [ "${ZERO_FILL_FREE_SPACE}" == true ]
+}
+
+# Trim freed blocks so images copied from this machine stay sparse
+# Falls back to zero filling free space when the underlying device does not support discard
+function sparsify_filesystems {
+    local mountpoint
+    local trimmed
+    local zerofile
+    local free_mb
+    local fill_mb
+    local free_before
+    local free_after
+
+    while read -r mountpoint; do
+        trimmed=$(fstrim -v "${mountpoint}" 2>> "${LOG_FILE}")
+        if [ $? -eq 0 ]; then
+            # fstrim -v outputs "/: 1.2 GiB (1288490188 bytes) trimmed"
+            trimmed=$(echo "${trimmed}" | sed -n 's/.*(\([0-9]*\) bytes).*/\1/p')
+            log "Discarded ${trimmed} bytes of free space on ${mountpoint}"
+        elif [[ "${mountpoint}" == "${ZERO_FILL_EXCLUDE}"* ]]; then
+            log "Discard not supported on ${mountpoint}, not zero filling VM images storage"
+        elif ! is_zero_fill_allowed; then
+            log "Discard not supported on ${mountpoint}, skipping zero fill since ZERO_FILL_FREE_SPACE=${ZERO_FILL_FREE_SPACE} on host ${host:-physical}"
+        else
+            free_mb=$(df -BM --output=avail "${mountpoint}" | tail -n 1 | tr -d ' M')
+            fill_mb=$((free_mb - ZERO_FILL_RESERVE_MB))
+            if [ "${fill_mb}" -le 0 ]; then
+                log "Discard not supported on ${mountpoint}, but only ${free_mb}MiB free space left, skipping zero fill"
+                continue
+            fi
+            log "Discard not supported on ${mountpoint}, zero filling ${fill_mb}MiB of free space"
+            free_before=$(df -B1 --output=avail "${mountpoint}" | tail -n 1 | tr -d ' ')
+            zerofile="${mountpoint%/}/.npf_zerofill"
+            # Keep ZERO_FILL_RESERVE_MB free instead of writing until the filesystem is full
+            dd if=/dev/zero of="${zerofile}" bs=1M count="${fill_mb}" conv=fsync status=none 2>> "${LOG_FILE}" || log "Zero filling ${mountpoint} stopped early"
+            free_after=$(df -B1 --output=avail "${mountpoint}" | tail -n 1 | tr -d ' ')
+            rm -f "${zerofile}" || log "Cannot remove ${zerofile}" "ERROR"
+            # We cannot see the host side allocation from here, zeroed blocks are only freed once the host
+            # sparsifies the disk image (virt-sparsify, qemu-img convert, or a sparse copy)
+            log "Zero filled $((free_before - free_after)) bytes of free space on ${mountpoint}, reclaimable by sparsifying the disk image on the host"
+        fi
+    done < <(findmnt -rn -t xfs,ext4 -O rw -o TARGET)
+}
+
+# Discard swap content, then recreate it with the same UUID and label so fstab stays valid
+function compact_swap {
+    local swap_device
+    local uuid
+    local label
+    local size
+
+    while read -r swap_device; do
+        [[ "${swap_device}" != /dev/* ]] && continue
+        uuid=$(blkid -s UUID -o value "${swap_device}")
+        label=$(blkid -s LABEL -o value "${swap_device}")
+        size=$(blockdev --getsize64 "${swap_device}")
+        # Without UUID we couldn't recreate a swap matching fstab, so don't touch it
+        if [ -z "${uuid}" ] || [ -z "${size}" ]; then
+            log "Cannot read UUID or size of swap ${swap_device}, not compacting it"
+            continue
+        fi
+        swapoff "${swap_device}" 2>> "${LOG_FILE}" || { log "Cannot disable swap on ${swap_device}" "ERROR"; continue; }
+        if blkdiscard -f "${swap_device}" 2>> "${LOG_FILE}"; then
+            log "Discarded ${size} bytes of swap on ${swap_device}"
+        elif is_zero_fill_allowed; then
+            log "Discard not supported on ${swap_device}, zero filling it"
+            dd if=/dev/zero of="${swap_device}" bs=1M conv=fsync status=none 2> /dev/null
+            log "Zero filled ${size} bytes of swap on ${swap_device}, reclaimable by sparsifying the disk image on the host"
+        else
+            log "Discard not supported on ${swap_device}, skipping zero fill since ZERO_FILL_FREE_SPACE=${ZERO_FILL_FREE_SPACE} on host ${host:-physical}"
+        fi
+        mkswap -U "${uuid}" ${label:+-L "${label}"} "${swap_device}" > /dev/null 2>> "${LOG_FILE}" || log "Cannot recreate swap on ${swap_device}" "ERROR"
+        swapon "${swap_device}" 2>> "${LOG_FILE}" || log "Cannot enable swap on ${swap_device}" "ERROR"
+    done < <(swapon --show=NAME --noheadings --raw)
+}
+
 echo "#### Installing prerequisites ####"
 
 dnf install -y epel-release || log "Failed to install epel release" "ERROR"
@@ -151,7 +252,12 @@ grub2-mkconfig -o /boot/grub2/grub.cfg || log "Failed to generate grub.cfg" "ERR
 
 echo "#### Identifying system ####"
 
-host=$(virt-what)
+# No need to probe the hypervisor when install facts already tell us we're on physical hardware
+if [ "${IS_VIRTUAL}" == false ]; then
+    host="physical"
+else
+    host=$(virt-what)
+fi
 
 case "$host" in
         *"redhat"*)
@@ -194,6 +300,11 @@ echo "#### Cleanup system files ####"
 /bin/rm -rf /var/lib/authselect/backups/*
 #/bin/rm -rf /var/log/anaconda
 
+echo "#### Sparsify system ####"
+sync
+sparsify_filesystems
+compact_swap
+
 if [ "${SCRIPT_GOOD}" == false ]; then
     echo "#### WARNING Installation FAILED ####"
     exit 1
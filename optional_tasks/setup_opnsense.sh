@@ -1,12 +1,21 @@
 #!/usr/bin/env bash
 
-## OPNSense Installer 2024110501 for RHEL9 with PCI passthrough preconfigured
+## OPNSense Installer 2026101901 for RHEL9 with PCI passthrough preconfigured
 
 # Requirements:
 # RHEL9 installed with NPF hypervisor script
 
 IMAGE_DIR=/var/lib/libvirt/images
 
+# Mirror to download images from. Can also be a local mirror directory or a file:// URL
+# containing the same layout as the official mirrors, ie <mirror>/<version>/OPNsense-<version>-*.bz2
+[ -z "${OPNSENSE_MIRROR}" ] && OPNSENSE_MIRROR="https://mirror.ams1.nl.leaseweb.net/opnsense/releases"
+
+# Image type can be
+# - dvd: Installer ISO attached as cdrom to the VM
+# - nano: Preinstalled disk image written directly into the VM disk
+[ -z "${IMAGE_TYPE}" ] && IMAGE_TYPE=dvd
+
 # VM Configuration
 VCPUS=6
 RAM=10240
@@ -60,58 +69,99 @@ if [ "$3" == "" ]; then
     usage
 fi
 
-dnf install -y bzip2 aria2
+dnf install -y bzip2 || log_quit "Failed to install bzip2"
+# lbzip2 is in EPEL and allows parallel decompression of streamed bzip2 data
+dnf install -y lbzip2 > /dev/null 2>&1 || log "lbzip2 not available, falling back to single threaded bzip2"
 
-#if ! type bzip2 > /dev/null 2>&1; then
-#    echo "No bzip2 installed"
-#    exit 1
-#fi
+if type -p lbzip2 > /dev/null 2>&1; then
+    DECOMPRESS_CMD="lbzip2 -dc -n $(nproc)"
+else
+    DECOMPRESS_CMD="bzip2 -dc"
+fi
+
+if [ "${IMAGE_TYPE}" != "dvd" ] && [ "${IMAGE_TYPE}" != "nano" ]; then
+    log_quit "Image type needs to be dvd or nano"
+fi
+
+# Allow local mirror directories
+if [ -d "${OPNSENSE_MIRROR}" ]; then
+    OPNSENSE_MIRROR="file://${OPNSENSE_MIRROR}"
+fi
 
-# Download latest opnsense
 if [ ! -d "${IMAGE_DIR}" ]; then
     log_quit "Image dir ${IMAGE_DIR} does not exist. Are we on a KVM machine ?"
 fi
 
 cd "${IMAGE_DIR}" || log_quit "Cannot cd to ${IMAGE_DIR}"
-log "Downloading OPNsense image"
-aria2c "https://mirror.ams1.nl.leaseweb.net/opnsense/releases/$2/OPNsense-$2-dvd-amd64.iso.bz2"
-if [ $? -ne 0 ]; then
-    log_quit "Failed to download OPNSense v$2"
+
+PRODUCT=vmv4kvhv
+TENANT=${1}
+VM="opnsense01p.${TENANT}.local"
+DISKPATH="${IMAGE_DIR}"
+
+if [ "${IMAGE_TYPE}" == "nano" ]; then
+    IMAGE_NAME="OPNsense-$2-nano-amd64.img.bz2"
+    # nano images are written directly into the VM disk, which needs to be raw so we can write it sparse
+    TARGET_FILE="${DISKPATH}/${VM}-disk0.raw"
+else
+    IMAGE_NAME="OPNsense-$2-dvd-amd64.iso.bz2"
+    TARGET_FILE="${IMAGE_DIR}/${IMAGE_NAME%.*}"
 fi
+CHECKSUM_FILE="${IMAGE_DIR}/OPNsense-$2-checksums-amd64.sha256"
 
-curl -OL "https://mirror.ams1.nl.leaseweb.net/opnsense/releases/$2/OPNsense-$2-checksums-amd64.sha256"
+log "Downloading OPNsense v$2 checksums from ${OPNSENSE_MIRROR}"
+curl -sSfL -o "${CHECKSUM_FILE}" "${OPNSENSE_MIRROR}/$2/OPNsense-$2-checksums-amd64.sha256"
 if [ $? -ne 0 ]; then
     log_quit "Failed to download OPNSense v$2 checksums"
 fi
+expected_checksum=$(grep "(${IMAGE_NAME})" "${CHECKSUM_FILE}" | awk '{ print $NF }')
+if [ -z "${expected_checksum}" ]; then
+    log_quit "No checksum found for ${IMAGE_NAME} in ${CHECKSUM_FILE}"
+fi
 
-log "Checking SHA256 SUM"
-OPNSENSE_ISO="${IMAGE_DIR}/OPNsense-$2-dvd-amd64.iso.bz2"
-CHECKSUM_FILE="${IMAGE_DIR}/OPNsense-$2-checksums-amd64.sha256"
-if [ ! -f "${OPNSENSE_ISO}" ]; then
-    log_quit "ISO File not existent"
+# Single pass over the data: the compressed stream is hashed while being downloaded,
+# decompressed in parallel and written sparse to the target file, so zeroed blocks don't use disk space
+log "Streaming ${IMAGE_NAME} to ${TARGET_FILE} using ${DECOMPRESS_CMD}"
+checksum_result=$(mktemp)
+# The compressed stream is hashed by a background reader of a named FIFO, so we can wait for its result
+checksum_fifo=$(mktemp -u)
+mkfifo "${checksum_fifo}" || log_quit "Cannot create checksum FIFO ${checksum_fifo}"
+sha256sum < "${checksum_fifo}" | awk '{ print $1 }' > "${checksum_result}" &
+checksum_pid=$!
+# shellcheck disable=SC2086
+curl -sSfL "${OPNSENSE_MIRROR}/$2/${IMAGE_NAME}" | tee "${checksum_fifo}" | ${DECOMPRESS_CMD} | dd of="${TARGET_FILE}" bs=1M conv=sparse status=none
+pipeline_result=("${PIPESTATUS[@]}")
+wait "${checksum_pid}"
+rm -f "${checksum_fifo}"
+# A failing command makes the ones before it fail with a write error, so check them from the end of the pipeline
+# Curl exit code 23 is such a write error, any other failure means the download itself failed
+if [ "${pipeline_result[0]}" -ne 0 ] && [ "${pipeline_result[0]}" -ne 23 ]; then
+    rm -f "${TARGET_FILE}" "${checksum_result}"
+    log_quit "Failed to download OPNSense v$2"
 fi
-if [ ! -f "${CHECKSUM_FILE}" ]; then
-    log_quit "Checksum File not existent"
+if [ "${pipeline_result[3]}" -ne 0 ]; then
+    rm -f "${TARGET_FILE}" "${checksum_result}"
+    log_quit "Failed to write image to ${TARGET_FILE}"
 fi
-checksum=$(sha256sum "${OPNSENSE_ISO}" | awk '{ print $1 }')
-if ! grep "${checksum}" "${CHECKSUM_FILE}"; then
-    log_quit "Downloaded OPNsense checksum is invalid"
-fi
-log "Decompressing image"
-bzip2 -d "${OPNSENSE_ISO}"
-if [ $? -ne 0 ]; then
+if [ "${pipeline_result[2]}" -ne 0 ]; then
+    rm -f "${TARGET_FILE}" "${checksum_result}"
     log_quit "Failed to decompress image"
 fi
-# Removing .bz2 extension
-OPNSENSE_ISO="${OPNSENSE_ISO%.*}"
+if [ "${pipeline_result[1]}" -ne 0 ]; then
+    rm -f "${TARGET_FILE}" "${checksum_result}"
+    log_quit "Failed to checksum image"
+fi
+
+log "Checking SHA256 SUM"
+checksum=$(cat "${checksum_result}")
+rm -f "${checksum_result}"
+if [ "${checksum}" != "${expected_checksum}" ]; then
+    rm -f "${TARGET_FILE}"
+    log_quit "Downloaded OPNsense checksum is invalid"
+fi
+log "Image written to ${TARGET_FILE} ($(du -h "${TARGET_FILE}" | awk '{ print $1 }') allocated)"
 
-PRODUCT=vmv4kvhv
-TENANT=${1}
-VM="opnsense01p.${TENANT}.local"
-DISKPATH="${IMAGE_DIR}"
-FULL_DISKPATH="${DISKPATH}/${VM}-disk0.qcow2"
 IO_MODE=,io="native,driver.iothread=${VCPUS},driver.queues=${VCPUS} --iothreads ${VCPUS}"
-ISO="${OPNSENSE_ISO}"
 
 PCI_PASSTHROUGH="--network none"
 IFS=',' read -r -a host_devices <<< "${3}"
@@ -120,9 +170,19 @@ for host_device in "${host_devices[@]}"; do
     PCI_PASSTHROUGH="${PCI_PASSTHROUGH} --host-device ${host_device}"
 done
 
-qemu-img create -f qcow2 -o extended_l2=on -o preallocation=metadata "${FULL_DISKPATH}" "${DISK_SIZE}" || log_quit "Failed to create disk"
+if [ "${IMAGE_TYPE}" == "nano" ]; then
+    FULL_DISKPATH="${TARGET_FILE}"
+    # Growing a raw image only changes its apparent size, OPNsense nano will grow its FS on first boot
+    qemu-img resize -f raw "${FULL_DISKPATH}" "${DISK_SIZE}" || log_quit "Failed to resize disk"
+    INSTALL_MEDIA="--import"
+else
+    FULL_DISKPATH="${DISKPATH}/${VM}-disk0.qcow2"
+    qemu-img create -f qcow2 -o extended_l2=on -o preallocation=metadata "${FULL_DISKPATH}" "${DISK_SIZE}" || log_quit "Failed to create disk"
+    INSTALL_MEDIA="--cdrom ${TARGET_FILE}"
+fi
 chown qemu:qemu "${FULL_DISKPATH}" || log "Failed to change disk owner" "ERROR"
-virt-install --name "${VM}" --ram "${RAM}" --vcpus "${VCPUS}" --cpu host --os-variant "${OS_VARIANT}" --disk path="${FULL_DISKPATH},bus=virtio,cache=none${IO_MODE}" --channel unix,mode=bind,target_type=virtio,name=org.qemu.guest_agent.0 --watchdog i6300esb,action=reset --sound none --boot hd --autostart --sysinfo smbios,bios.vendor=npf --sysinfo smbios,system.manufacturer=NetPerfect --sysinfo smbios,system.product="${PRODUCT}" --cdrom "${ISO}" --graphics vnc,listen=127.0.0.1,keymap=fr --autoconsole text "${PCI_PASSTHROUGH}"
+# shellcheck disable=SC2086
+virt-install --name "${VM}" --ram "${RAM}" --vcpus "${VCPUS}" --cpu host --os-variant "${OS_VARIANT}" --disk path="${FULL_DISKPATH},bus=virtio,cache=none${IO_MODE}" --channel unix,mode=bind,target_type=virtio,name=org.qemu.guest_agent.0 --watchdog i6300esb,action=reset --sound none --boot hd --autostart --sysinfo smbios,bios.vendor=npf --sysinfo smbios,system.manufacturer=NetPerfect --sysinfo smbios,system.product="${PRODUCT}" ${INSTALL_MEDIA} --graphics vnc,listen=127.0.0.1,keymap=fr --autoconsole text "${PCI_PASSTHROUGH}"
 [ $? -ne 0 ] && log "Failed to launch virt-install" "ERROR"
 
 if [ "${SCRIPT_GOOD}" == false ]; then
@@ -1,6 +1,6 @@
 #!/usr/bin/env bash
 
-## Readonly setup script 2024110501 for RHEL9
+## Readonly setup script 2026101901 for RHEL9
 
 # Requirements:
 # RHEL9 installed
@@ -28,7 +28,18 @@ function log_quit {
     exit 1
 }
 
-target="${1:-false}"
+# optional, facts detected at install time by the kickstart pre-script
+# shellcheck source=/dev/null
+[ -f /etc/npf-install-facts ] && source /etc/npf-install-facts
+
+# Default to hv target on machines installed with hv-stateless partition schema
+# TARGET comes from the install facts, not to be confused with our own target argument
+# shellcheck disable=SC2153
+if [ -z "${1}" ] && [ "${TARGET}" == "hv-stateless" ]; then
+    target=hv
+else
+    target="${1:-false}"
+fi
 
 if [ "${target}" != "ztl" ] && [ "${target}" != "hv" ]; then
     log_quit "Target needs to be ztl or hv"
@@ -85,8 +96,7 @@ fi
 echo "/var/log" > /etc/statetab.d/log || log "Cannot create /etc/statetab.d/log" "ERROR"
 sed -i 's:dirs\(.*\)/var/log:#/dirs\1/var/log # Configured in /etc/statetab to be persistent:g' /etc/rwtab 2>> "${LOG_FILE}" || log "Cannot comment out /var/log in /etc/rwtab" "ERROR"
 
-# Those dirs are stateful until reboot
-# Size is 1/2 of system RAM
+# Those dirs are stateful until reboot, in a tmpfs which size is set via RW_OPTIONS
 echo "dirs /var/log/tuned" >> /etc/rwtab.d/tuned || log "Cannot create /etc/rwtab.d/tuned" "ERROR"
 echo "files /etc/issue" >> /etc/rwtab.d/issue || log "Cannot create /etc/rwtab.d/issue" "ERROR"
 
@@ -100,6 +110,32 @@ if [ "${target}" == "ztl" ]; then
     echo "dirs /var/ztl_upgrade" >> /etc/rwtab.d/ztl || log "Cannot create /etc/rwtab.d/ztl" "ERROR"
 fi
 
+# Size the volatile tmpfs with the budget computed by the kickstart pre-script, instead of tmpfs default of 1/2 RAM
+# Without install facts, keep readonly-root default tmpfs size
+if [ -n "${READONLY_TMPFS_SIZE_MB}" ]; then
+    log "Setting readonly-root tmpfs size to ${READONLY_TMPFS_SIZE_MB}MiB"
+    if grep "^RW_OPTIONS=" /etc/sysconfig/readonly-root > /dev/null 2>&1; then
+        sed -i "s/^RW_OPTIONS=.*/RW_OPTIONS=\"-o size=${READONLY_TMPFS_SIZE_MB}m\"/g" /etc/sysconfig/readonly-root 2>> "${LOG_FILE}" || log "Cannot set tmpfs size" "ERROR"
+    else
+        echo "RW_OPTIONS=\"-o size=${READONLY_TMPFS_SIZE_MB}m\"" >> /etc/sysconfig/readonly-root || log "Cannot set tmpfs size" "ERROR"
+    fi
+else
+    log "No readonly-root budget in install facts, keeping default tmpfs size of 1/2 RAM"
+fi
+
+# Check that current persistent data fits the stateful partition
+stateful_device=$(blkid -L STATEFULRW 2>/dev/null)
+if [ -n "${stateful_device}" ]; then
+    stateful_size=$(($(blockdev --getsize64 "${stateful_device}") / 1048576))
+    persistent_size=$(cat /etc/statetab /etc/statetab.d/* 2>/dev/null | grep -v "^#" | xargs -r -d '\n' du -scm 2>/dev/null | tail -n 1 | awk '{ print $1 }')
+    log "Stateful partition ${stateful_device} is ${stateful_size}MiB, persistent directories currently use ${persistent_size:-0}MiB"
+    if [ "${persistent_size:-0}" -gt $((stateful_size * 80 / 100)) ]; then
+        log "Persistent directories use more than 80% of stateful partition" "ERROR"
+    fi
+else
+    log "No STATEFULRW partition found, cannot check stateful storage budget"
+fi
+
 # Optional for xauth support
 #echo "files /root" >> /etc/rwtab.d/xauth                # X11 forwarding (xauth)
 # NPF-MOD-USER: Change the username to whatever fits !!!